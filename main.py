@@ -10,6 +10,8 @@ import folium
 import pandas as pd
 import altair as alt
 from streamlit_folium import st_folium
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from branca.element import Template, MacroElement
 
@@ -23,97 +25,155 @@ st.set_page_config(
 # --- CONSTANTES ---
 ASSET_ID = "projects/ee-cando/assets/areas_urbanas_Tab"
 MAX_NUBES = 30
+# Histograma de LST: misma escala calibrada que el mapa, 20 intervalos
+HIST_MIN, HIST_MAX, HIST_BINS = 25, 55, 20
+# Visualización de las capas del mapa (escala de LST calibrada)
+VIZ_LST = {"min": 25, "max": 55, "palette": ['blue', 'cyan', 'yellow', 'orange', 'red', 'maroon']}
+VIZ_NDVI = {"min": 0, "max": 0.6, "palette": ['brown', 'white', 'green']}
+GEE_ENDPOINT = "https://earthengine-highvolume.googleapis.com"
+# Tolerancia (m) al simplificar las áreas urbanas: por debajo del píxel de 30 m
+ROI_MAX_ERROR = 10
+# Landsat C2 L2 ST_B10 -> °C: escala y desplazamiento (149.0 - 273.15) ya combinados
+LST_SCALE, LST_OFFSET = 0.00341802, -124.15
+
+# Cabeceras disponibles en el asset de áreas urbanas
+CIUDADES = (
+    "Villahermosa", "Teapa", "Cárdenas", "Comalcalco", "Paraíso",
+    "Frontera", "Macuspana", "Tenosique", "Huimanguillo", "Cunduacán",
+    "Jalpa de Méndez", "Nacajuca", "Jalapa", "Tacotalpa", "Emiliano Zapata",
+)
+CIUDADES_SET = frozenset(CIUDADES)
+
+# Coordenadas (lat, lon) de cada cabecera para centrar el mapa sin consultar GEE
+COORDENADAS = {
+    "Villahermosa": (17.9895, -92.9183),
+    "Teapa": (17.5486, -92.9525),
+    "Cárdenas": (18.0011, -93.3756),
+    "Comalcalco": (18.2642, -93.2236),
+    "Paraíso": (18.3981, -93.2142),
+    "Frontera": (18.5336, -92.6456),
+    "Macuspana": (17.7608, -92.5983),
+    "Tenosique": (17.4742, -91.4236),
+    "Huimanguillo": (17.8333, -93.3889),
+    "Cunduacán": (18.0650, -93.1731),
+    "Jalpa de Méndez": (18.1764, -93.0631),
+    "Nacajuca": (18.1692, -93.0178),
+    "Jalapa": (17.7217, -92.8125),
+    "Tacotalpa": (17.5958, -92.8256),
+    "Emiliano Zapata": (17.7406, -91.7664),
+    "Balancán": (17.8078, -91.5367),
+    "Jonuta": (18.0897, -92.1381),
+}
 
 # --- MAPAS BASE ---
+# Solo URL y atribución: cada mapa crea sus propias TileLayer (no se comparten instancias entre mapas)
 BASEMAPS = {
-    "Google Maps": folium.TileLayer(
-        tiles="https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}",
-        attr="Google", name="Google Maps", overlay=False, control=True,
-    ),
-    "Google Satellite": folium.TileLayer(
-        tiles="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
-        attr="Google", name="Google Satellite", overlay=False, control=True,
-    ),
-    "Google Hybrid": folium.TileLayer(
-        tiles="https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}",
-        attr="Google", name="Google Hybrid", overlay=False, control=True,
-    ),
-    "Esri Satellite": folium.TileLayer(
-        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-        attr="Esri", name="Esri Satellite", overlay=False, control=True,
-    ),
+    "Google Maps": {
+        "tiles": "https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}", "attr": "Google",
+    },
+    "Google Satellite": {
+        "tiles": "https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}", "attr": "Google",
+    },
+    "Google Hybrid": {
+        "tiles": "https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}", "attr": "Google",
+    },
+    "Esri Satellite": {
+        "tiles": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+        "attr": "Esri",
+    },
 }
+# Cada mapa carga solo dos capas base: la elegida en la barra lateral y una alternativa
+BASEMAPS_DEFAULT = ("Google Maps", "Google Satellite")
 
 # --- 2. GESTIÓN DE ESTADO ---
 if "locality" not in st.session_state:
     st.session_state.locality = "Villahermosa"
 if "coordinates" not in st.session_state:
-    st.session_state.coordinates = (17.9895, -92.9183)
+    st.session_state.coordinates = COORDENADAS["Villahermosa"]
 if "date_range" not in st.session_state:
     st.session_state.date_range = (dt.date(2024, 4, 1), dt.date(2024, 5, 30))
+if "date_strs" not in st.session_state:
+    # Fechas ya formateadas para GEE: se usan tal cual en las claves de caché
+    st.session_state.date_strs = tuple(d.strftime("%Y-%m-%d") for d in st.session_state.date_range)
 if "gee_available" not in st.session_state:
     st.session_state.gee_available = False
 if "window" not in st.session_state:
     st.session_state.window = "Mapas"
 if "compare_cities" not in st.session_state:
     st.session_state.compare_cities = ["Villahermosa", "Teapa"]
+if "basemap" not in st.session_state:
+    st.session_state.basemap = BASEMAPS_DEFAULT[0]
 
 # --- 3. CONEXIÓN GEE ---
+@st.cache_resource(show_spinner=False)
+def _init_gee():
+    """Inicializa Earth Engine una sola vez por proceso (compartido entre sesiones)"""
+    if 'GEE_SERVICE_ACCOUNT' in st.secrets and 'GEE_PRIVATE_KEY' in st.secrets:
+        service_account = st.secrets["GEE_SERVICE_ACCOUNT"]
+        raw_key = st.secrets["GEE_PRIVATE_KEY"]
+        private_key = raw_key.strip().replace('\\n', '\n')
+        credentials = ee.ServiceAccountCredentials(service_account, key_data=private_key)
+        ee.Initialize(credentials, opt_url=GEE_ENDPOINT)
+    else:
+        ee.Initialize(opt_url=GEE_ENDPOINT)
+    return True
+
 def connect_with_gee():
-    if st.session_state.gee_available: return True
     try:
-        if 'GEE_SERVICE_ACCOUNT' in st.secrets and 'GEE_PRIVATE_KEY' in st.secrets:
-            service_account = st.secrets["GEE_SERVICE_ACCOUNT"]
-            raw_key = st.secrets["GEE_PRIVATE_KEY"]
-            private_key = raw_key.strip().replace('\\n', '\n')
-            credentials = ee.ServiceAccountCredentials(service_account, key_data=private_key)
-            ee.Initialize(credentials)
-            st.session_state.gee_available = True
-            return True
-        else:
-            ee.Initialize()
-            st.session_state.gee_available = True
-            return True
+        st.session_state.gee_available = _init_gee()
     except Exception as e:
         st.error(f"Error GEE: {e}")
         st.session_state.gee_available = False
-        return False
+    return st.session_state.gee_available
 
 # --- 4. FUNCIONES DE PROCESAMIENTO ---
 
-def cloudMaskFunction(image):
-    qa = image.select("QA_PIXEL")
-    mask = qa.bitwiseAnd(1 << 3).eq(0).And(qa.bitwiseAnd(1 << 5).eq(0))
-    return image.updateMask(mask)
-
-def maskThermalNoData(image):
-    st_band = image.select("ST_B10")
-    return image.updateMask(st_band.gt(0).And(st_band.lt(65535)))
-
 def addNDVI(image):
     ndvi = image.normalizedDifference(['SR_B5', 'SR_B4']).rename('NDVI')
     return image.addBands(ndvi)
 
 def addLST(image):
-    lst = (image.select("ST_B10")
-           .multiply(0.00341802).add(149.0).subtract(273.15).rename("LST"))
+    lst = image.expression(
+        f"b * {LST_SCALE} + ({LST_OFFSET})", {"b": image.select("ST_B10")}
+    ).rename("LST")
     return image.addBands(lst)
 
+def preprocess_lst_only(image):
+    """Máscaras de nubes y térmica en un solo updateMask, más LST: un único .map()"""
+    qa = image.select("QA_PIXEL")
+    st_band = image.select("ST_B10")
+    # Bit 3 (nube) y bit 5 (nieve) con una sola máscara combinada, más píxeles térmicos válidos
+    mask = (qa.bitwiseAnd((1 << 3) | (1 << 5)).eq(0)
+            .And(st_band.gt(0)).And(st_band.lt(65535)))
+    return addLST(image.updateMask(mask))
+
+def preprocess_lst_ndvi(image):
+    """Como preprocess_lst_only, añadiendo NDVI sobre la imagen ya enmascarada"""
+    return addNDVI(preprocess_lst_only(image))
+
 # --- 5. INTEGRACIÓN FOLIUM ---
+@st.cache_data(ttl=1800, show_spinner=False)
+def _get_tile_url(serialized_image, vis_params):
+    """URL de teselas de getMapId; el grafo serializado es determinista y sirve como clave de caché"""
+    image = ee.Image(ee.deserializer.fromJSON(serialized_image))
+    return image.getMapId(vis_params)["tile_fetcher"].url_format
+
+def _outline_image(geometry):
+    """Contorno de 2 px de una geometría o FeatureCollection, pintado en GEE sobre una imagen vacía"""
+    if isinstance(geometry, ee.geometry.Geometry):
+        geometry = ee.FeatureCollection([ee.Feature(geometry)])
+    return ee.Image().byte().paint(featureCollection=geometry, color=1, width=2)
+
 def add_ee_layer(self, ee_object, vis_params, name):
     try:
         if isinstance(ee_object, ee.image.Image):
-            map_id_dict = ee.Image(ee_object).getMapId(vis_params)
             folium.raster_layers.TileLayer(
-                tiles=map_id_dict["tile_fetcher"].url_format,
+                tiles=_get_tile_url(ee_object.serialize(), vis_params),
                 attr="Google Earth Engine", name=name, overlay=True, control=True,
             ).add_to(self)
         elif isinstance(ee_object, ee.geometry.Geometry) or isinstance(ee_object, ee.featurecollection.FeatureCollection):
-            folium.GeoJson(
-                data=ee_object.getInfo(), name=name,
-                style_function=lambda x: {'color': 'black', 'fillColor': 'transparent', 'weight': 2},
-                overlay=True, control=True
-            ).add_to(self)
+            # Contorno pintado en GEE y servido como teselas: el GeoJSON no viaja al navegador
+            add_ee_layer(self, _outline_image(ee_object), {'palette': vis_params.get('palette', '000000')}, name)
     except Exception as e:
         print(f"Error capa {name}: {e}")
 
@@ -151,492 +211,222 @@ def add_legend(m, title, colors, vmin, vmax):
 def create_map(center=None, height=500):
     location = center if center else [st.session_state.coordinates[0], st.session_state.coordinates[1]]
     m = folium.Map(location=location, zoom_start=12, height=height, tiles=None)
-    for name, layer in BASEMAPS.items():
-        layer.add_to(m)
+    basemap = st.session_state.basemap
+    names = [basemap] + [name for name in BASEMAPS_DEFAULT if name != basemap][:1]
+    for name in names:
+        folium.TileLayer(**BASEMAPS[name], name=name, overlay=False, control=True).add_to(m)
     return m
 
+@st.cache_resource
+def _urban_areas():
+    return ee.FeatureCollection(ASSET_ID)
+
+def _locality_geometry(locality_name):
+    """Geometría de la localidad como referencia al asset, sin consultar GEE (el nombre ya debe estar validado)"""
+    # Mismo cálculo que get_roi_info, pero diferido: GEE lo resuelve (y reutiliza) en el servidor
+    target = _urban_areas().filter(ee.Filter.eq("NOMGEO", locality_name))
+    return target.geometry().simplify(maxError=ROI_MAX_ERROR)
+
 def get_roi(locality_name):
-    urban_areas = ee.FeatureCollection(ASSET_ID)
-    target = urban_areas.filter(ee.Filter.eq("NOMGEO", locality_name))
-    if target.size().getInfo() > 0:
-        return target.geometry()
-    return None
+    """Geometría GEE de la localidad como referencia al asset: las consultas no llevan sus vértices"""
+    geojson, _ = get_roi_info(locality_name)
+    if geojson is None:
+        return None
+    return _locality_geometry(locality_name)
+
+def polygon_centroid(geojson):
+    """Centroide (lat, lon) de un Polygon/MultiPolygon GeoJSON, calculado en el cliente"""
+    if geojson["type"] == "Polygon":
+        polygons = [geojson["coordinates"]]
+    elif geojson["type"] == "MultiPolygon":
+        polygons = geojson["coordinates"]
+    else:
+        polygons = [g["coordinates"] for g in geojson.get("geometries", []) if g["type"] == "Polygon"]
+
+    area = mx = my = 0.0
+    for polygon in polygons:
+        for i, ring in enumerate(polygon):
+            a = cx = cy = 0.0
+            for (x0, y0), (x1, y1) in zip(ring, ring[1:]):
+                cross = x0 * y1 - x1 * y0
+                a += cross
+                cx += (x0 + x1) * cross
+                cy += (y0 + y1) * cross
+            # El anillo exterior suma y los huecos restan, sin importar la orientación
+            sign = (1 if i == 0 else -1) * (1 if a >= 0 else -1)
+            area += sign * a / 2
+            mx += sign * cx / 6
+            my += sign * cy / 6
+    if area == 0:
+        return None
+    return (my / area, mx / area)
+
+def polygon_bounds(geojson):
+    """Límites [[sur, oeste], [norte, este]] de un Polygon/MultiPolygon GeoJSON, para fit_bounds"""
+    polygons = [geojson["coordinates"]] if geojson["type"] == "Polygon" else geojson["coordinates"]
+    xs = [x for polygon in polygons for x, _ in polygon[0]]
+    ys = [y for polygon in polygons for _, y in polygon[0]]
+    return [[min(ys), min(xs)], [max(ys), max(xs)]]
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_roi_info(locality_name):
+    """GeoJSON del área urbana y su centroide (lat, lon); una sola consulta a GEE"""
+    if locality_name not in CIUDADES_SET:
+        return None, None
+    target = _urban_areas().filter(ee.Filter.eq("NOMGEO", locality_name))
+    # first() es nulo en el servidor si no hay coincidencias: evita contar la colección.
+    # Simplificada a 10 m (menos que un píxel de 30 m): menos vértices en cada consulta que la use
+    geojson = ee.Algorithms.If(
+        target.first(), target.geometry().simplify(maxError=ROI_MAX_ERROR), None
+    ).getInfo()
+    if not geojson:
+        return None, None
+    return geojson, polygon_centroid(geojson)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_rois_info(locality_names):
+    """Como get_roi_info, pero para varias localidades en una sola consulta a GEE"""
+    names = [name for name in locality_names if name in CIUDADES_SET]
+    if not names:
+        return {}
+    fc = (_urban_areas().filter(ee.Filter.inList("NOMGEO", names))
+          .map(lambda f: f.simplify(maxError=ROI_MAX_ERROR)).select(["NOMGEO"]))
+    parts = {}
+    for feature in fc.getInfo()["features"]:
+        geometry = feature["geometry"]
+        polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+        parts.setdefault(feature["properties"]["NOMGEO"], []).extend(polygons)
+
+    rois = {}
+    for name, polygons in parts.items():
+        geojson = {"type": "MultiPolygon", "coordinates": polygons}
+        rois[name] = (geojson, polygon_centroid(geojson))
+    return rois
+
+@st.cache_resource(ttl=1800, show_spinner=False)
+def build_collection(locality_name, start, end):
+    """ROI, colección preprocesada y mediana LST/NDVI compartidas entre paneles (objetos GEE diferidos)"""
+    roi = get_roi(locality_name)
+    if roi is None:
+        return None, None, None
+    col = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
+           .filterBounds(roi).filterDate(start, end)
+           .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
+           .map(preprocess_lst_ndvi))
+    # median() sobre solo las dos bandas usadas: compuesto optimizado en GEE y teselas más rápidas
+    mosaic = col.select(["LST", "NDVI"]).median().clip(roi)
+    return roi, col, mosaic
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def compute_uhi(locality_name, start, end):
+    """Resultados del panel de mapa como datos planos: conteo, umbrales, centro y URLs de teselas"""
+    roi, col, mosaic = build_collection(locality_name, start, end)
+    if roi is None:
+        return None
+
+    n_images = col.size()
+    lst_band = mosaic.select("LST")
+    ndvi_band = mosaic.select("NDVI")
+    # Ambos umbrales (p90 de LST y p95 de NDVI) en una sola reducción sobre las dos bandas;
+    # histograma acotado a 256 intervalos: percentil aproximado, de sobra para un umbral de mapa
+    thresholds = mosaic.select(["LST", "NDVI"]).reduceRegion(
+        reducer=ee.Reducer.percentile([90, 95], maxBuckets=256), geometry=roi,
+        scale=30, maxPixels=1e8, tileScale=4,
+    )
+    p90 = thresholds.get("LST_p90")
+    p95_ndvi = thresholds.get("NDVI_p95")
+
+    # Una sola consulta: número de imágenes y umbrales (nulos si la colección está vacía)
+    info = ee.Dictionary({
+        "count": n_images,
+        "p90": ee.Algorithms.If(n_images.gt(0), p90, None),
+        "p95": ee.Algorithms.If(n_images.gt(0), p95_ndvi, None),
+    }).getInfo()
+
+    centroid = COORDENADAS.get(locality_name) or get_roi_info(locality_name)[1]
+
+    # Capas como (nombre, imagen, visualización); las URL se piden después, en paralelo
+    specs = [("Límite Urbano", _outline_image(roi), {'palette': '000000'})]
+
+    if info["count"] > 0:
+        specs.append(("1. LST (°C)", lst_band, VIZ_LST))
+        if info["p90"] is not None:
+            uhi = lst_band.gte(ee.Number(p90))
+            # Apertura morfológica (erosión + dilatación) para eliminar píxeles aislados
+            uhi_clean = (uhi.focal_min(radius=1, kernelType="square")
+                         .focal_max(radius=1, kernelType="square")
+                         .selfMask())
+            specs.append((f"2. Hotspots (> {info['p90']:.1f}°C)", uhi_clean, {"palette": ['#000000']}))
+        specs.append(("3. NDVI", ndvi_band, VIZ_NDVI))
+        if info["p95"] is not None:
+            veg_mask = ndvi_band.gte(ee.Number(p95_ndvi)).selfMask()
+            specs.append((f"4. Refugios Verdes (> {info['p95']:.2f})", veg_mask, {"palette": ['#00FF00']}))
+
+    # Cada getMapId es una consulta independiente: en hilos, la espera total es la de la más lenta
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=len(specs), initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        urls = list(executor.map(lambda spec: _get_tile_url(spec[1].serialize(), spec[2]), specs))
+    # Cadenas (nombre, URL de teselas): se pueden guardar en caché
+    layers = [(name, url) for (name, _, _), url in zip(specs, urls)]
+
+    return {"count": info["count"], "p90": info["p90"], "p95": info["p95"],
+            "centroid": centroid, "layers": layers}
 
 # --- 6. PANELES PRINCIPALES ---
 
+@st.fragment
 def show_map_panel():
     st.markdown(f"### 🗺️ Monitor Urbano: {st.session_state.locality}")
     if not connect_with_gee(): return
     
-    roi = get_roi(st.session_state.locality)
-
-<<<<<<< HEAD
-    map = create_map()
-    if map == None:
-        return
-
-    connect_with_gee()
-
-    if st.session_state.gee_available:
-        # # Add custom BASEMAPS
-        # BASEMAPS["Google Maps"].add_to(map)
-        BASEMAPS["Google Satellite Hybrid"].add_to(map)
-
-        # CGAZ_ADM0 = ee.FeatureCollection("projects/earthengine-legacy/assets/projects/sat-io/open-datasets/geoboundaries/CGAZ_ADM0");
-        # CGAZ_ADM1 = ee.FeatureCollection("projects/earthengine-legacy/assets/projects/sat-io/open-datasets/geoboundaries/CGAZ_ADM1");
-        # CGAZ_ADM2 = ee.FeatureCollection(
-        #     "projects/earthengine-legacy/assets/projects/sat-io/open-datasets/geoboundaries/CGAZ_ADM2"
-        # )
-
-        roi = (
-            ee.FeatureCollection(os.getenv("GEE_LOCALITIES_ASSET"))
-            .filter(ee.Filter.eq("NOMGEO", st.session_state.locality))
-            .geometry()
-        )
-
-        collection = (
-            ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-            .filterDate(
-                (dt.datetime.fromisoformat(str(st.session_state.date_range[0]))),
-                dt.datetime.fromisoformat(str(st.session_state.date_range[1])),
-            )
-            .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
-            .map(lambda image: image.clip(roi))
-            .map(cloudMaskFunction)
-            .map(noThermalDataFunction)
-        )
-
-        # mosaico = collection.reduce(ee.Reducer.percentile([50]))
-
-        # mosaicoRGB = (
-        #     ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-        #     .filterBounds(roi)
-        #     .filterDate(
-        #         (dt.datetime.fromisoformat(str(st.session_state.date_range[0]))),
-        #         dt.datetime.fromisoformat(str(st.session_state.date_range[1])),
-        #     )
-        #     .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
-        #     .map(cloudMaskFunction)
-        #     .map(applyScale)
-        #     .median()
-        # )
-
-        # visColorVerdadero = {
-        #     "bands": ("SR_B4", "SR_B3", "SR_B2"),
-        #     "min": 0.0,
-        #     "max": 0.3,
-        # }
-
-        # map.add_ee_layer(mosaicoRGB, visColorVerdadero, "RGB")
-
-        # bandaTermica = mosaico.select("ST_B10_p50")
-
-        # # Aplicamos la fórmula de escalado para convertir a Kelvin y luego a Celsius.
-        # # Estos valores son específicos de la Colección 2 de Landsat (L2).
-        # lstCelsius = (
-        #     bandaTermica.multiply(0.00341802)
-        #     .add(149.0)
-        #     .subtract(273.15)
-        #     .rename("LST_Celsius")
-        # )
-
-        # visParamsLST = {
-        #     "palette": ["blue", "cyan", "green", "yellow", "red"],
-        #     "min": 28,
-        #     "max": 48,
-        # }
-
-        # map.add_ee_layer(lstCelsius, visParamsLST, "Temperatura Superficial (°C) p50")
-
-        # percentilUHI = 90
-        # minPixParche = 3
-
-        # lstForThreshold = lstCelsius.rename("LST")
-
-        # pctDict = lstForThreshold.reduceRegion(
-        #     reducer=ee.Reducer.percentile([percentilUHI]),
-        #     geometry=roi,
-        #     scale=30,
-        #     maxPixels=1e9,
-        #     bestEffort=True,
-        # )
-
-        # key = ee.String("LST_p").cat(ee.Number(percentilUHI).format())
-
-        # umbral = ee.Algorithms.If(
-        #     pctDict.contains(key),
-        #     ee.Number(pctDict.get(key)),
-        #     ee.Number(ee.Dictionary(pctDict).values().get(0)),
-        # )
-
-        # n_umbral = ee.Number(umbral)
-
-        # uhiMask = lstForThreshold.gte(n_umbral)
-
-        # compCount = uhiMask.connectedPixelCount(maxSize=1024, eightConnected=True)
-
-        # uhiClean = uhiMask.updateMask(compCount.gte(minPixParche)).selfMask()
-
-        # map.add_ee_layer(
-        #     uhiClean,
-        #     {"palette": ["#d7301f"]},
-        #     "Islas de calor (>= p" + str(percentilUHI) + ", clean)",
-        # )
-
-        # map.add_ee_layer(
-        #     lstCelsius.updateMask(uhiClean),
-        #     {
-        #         "min": visParamsLST["min"],
-        #         "max": visParamsLST["max"],
-        #         "palette": visParamsLST["palette"],
-        #     },
-        #     "LST en islas de calor",
-        # )
-
-        # style = {
-        #     "color": "0000ffff",
-        #     "width": 1,
-        #     "lineType": "solid",
-        #     "fillColor": "00000000",
-        # }
-
-        # map.add_ee_layer(roi.style(**style), {}, st.session_state.locality)
-
-        folium.LayerControl().add_to(map)
-
-    else:
-        st.toast("No hay conexión con Google Earth Engine, mostrando solo mapa base")
-
-    st_folium(map, width=None, height=600)
-
-
-# Configuración de streamlit
-st.set_page_config(
-    page_title="Islas de calor Tabasco",
-    page_icon="🌡️",
-    layout="wide",
-)
-
-
-# Configuración del sidebar
-with st.sidebar:
-    st.markdown("Islas de calor Tabasco")
-    st.caption("Dashboard base para análisis de islas de calor urbano (LST/NDVI)")
-
-    # Selector de sección
-    section = st.radio(
-        "Secciones",
-        ["Información","Mapas", "Gráficas"],
-        index=0,
-    )
-    st.session_state.window = section
-
-    # Filtros globales
-    st.markdown("Opciones")
-
-    st.markdown("Área de estudio (localidad)")
-    st.session_state.locality = st.selectbox(
-        "Definir localidad",
-        [
-            "Balancán",
-            "Cárdenas",
-            "Frontera",
-            "Villahermosa",
-            "Comalcalco",
-            "Cunduacán",
-            "Emiliano Zapata",
-            "Huimanguillo",
-            "Jalapa",
-            "Jalpa de Méndez",
-            "Jonuta",
-            "Macuspana",
-            "Nacajuca",
-            "Paraíso",
-            "Tacotalpa",
-            "Teapa",
-            "Tenosique",
-        ],
-    )
-
-    set_coordinates()
-
-    min_date, max_date = dt.date(2014, 1, 1), dt.datetime.now()
-    date_range = st.date_input(
-        "Rango de fechas",
-        value=st.session_state.date_range,
-        min_value=min_date,
-        max_value=max_date,
-        help="Periodo de análisis",
-    )
-    if isinstance(date_range, tuple) and len(date_range) == 2:
-        st.session_state.date_range = date_range
-
-    # if st.button("do something"):
-    #     # do something
-    #     st.session_state["locality"] = not st.session_state["locality"]
-    #     st.rerun()
-
-    # uploaded_geojson = None
-    # if locality_option == "Subir GeoJSON":
-    #     uploaded_geojson = st.file_uploader(
-    #         "Carga un archivo GeoJSON",
-    #         type=["geojson", "json"],
-    #         help="El sistema intentará usar esta geometría como locality",
-    #     )
-
-    # if st.button("Aplicar locality/Filtros"):
-    #     st.session_state.locality = uploaded_geojson if uploaded_geojson else "Teapa"
-    #     st.toast("Filtros aplicados", icon="✅")
-
-    # if st.button("Generar"):
-    #     show_map_panel()
-
-    # metricas = st.multiselect(
-    #     "Indicadores",
-    #     ["NDVI", "LST"],
-    #     default=["LST"],
-    #     help="Selecciona qué indicadores calcular/visualizar",
-    # )
-
-
-# --------------------------------------------------------------
-# Panel de gráficas
-# --------------------------------------------------------------
-def show_graphics_panel():
-    st.markdown("### 🌡️ Análisis de Temperatura Superficial (LST)")
-    st.caption(
-        f"Localidad seleccionada: **{st.session_state.locality}** | "
-        f"Periodo: {st.session_state.date_range[0]} — {st.session_state.date_range[1]}"
-    )
-
-    tipo_grafica = st.radio(
-        "Tipo de gráfica:",
-        ["Evolución temporal", "Comparación entre municipios"],
-        horizontal=True,
-    )
-
-    if not connect_with_gee():
-        st.error("No se pudo conectar con Google Earth Engine.")
-        return
-
-    # ======================================
-    # Definición de la colección Landsat 8
-    # ======================================
-    collection = (
-        ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-        .filterDate(
-            dt.datetime.fromisoformat(str(st.session_state.date_range[0])),
-            dt.datetime.fromisoformat(str(st.session_state.date_range[1])),
-        )
-        .filter(ee.Filter.lt("CLOUD_COVER", 30))
-        .map(cloudMaskFunction)
-        .map(noThermalDataFunction)
-    )
-
-    # Conversión de ST_B10 a °C
-    def calc_lst(img):
-        lst = img.select("ST_B10").multiply(0.00341802).add(149).subtract(273.15)
-        return lst.set("year", img.date().get("year"))
-
-    lst_collection = collection.map(calc_lst)
-
-    # ======================================
-    # MODO 1 — EVOLUCIÓN TEMPORAL
-    # ======================================
-    if tipo_grafica == "Evolución temporal":
-        roi = (
-            ee.FeatureCollection(os.getenv("GEE_LOCALITIES_ASSET"))
-            .filter(ee.Filter.eq("NOMGEO", st.session_state.locality))
-            .geometry()
-        )
-
-        # Reducir promedio por año
-        def yearly_mean(year):
-            start = ee.Date.fromYMD(year, 1, 1)
-            end = start.advance(1, "year")
-            year_coll = lst_collection.filterDate(start, end)
-            lst_mean = (
-                year_coll.mean()
-                .reduceRegion(
-                    reducer=ee.Reducer.mean(),
-                    geometry=roi,
-                    scale=30,
-                    maxPixels=1e9,
-                )
-                .get("ST_B10")
-            )
-            return ee.Feature(None, {"year": year, "LST_media": lst_mean})
-
-        years = ee.List.sequence(2014, 2024)
-        lst_by_year = ee.FeatureCollection(years.map(yearly_mean)).getInfo()
-
-        # Convertir a DataFrame
-        data = []
-        for f in lst_by_year["features"]:
-            props = f["properties"]
-            if props["LST_media"] is not None:
-                data.append([int(props["year"]), float(props["LST_media"])])
-
-        df = pd.DataFrame(data, columns=["Año", "LST_media"]).sort_values("Año")
-        st.success(f"✅ Datos reales obtenidos de {st.session_state.locality}.")
-        st.line_chart(df, x="Año", y="LST_media")
-        st.caption("Evolución anual de la temperatura superficial promedio (°C).")
-
-    # ======================================
-    # MODO 2 — COMPARACIÓN ENTRE MUNICIPIOS
-    # ======================================
-    elif tipo_grafica == "Comparación entre municipios":
-        localidades = [
-            "Balancán", "Cárdenas", "Frontera", "Villahermosa", "Comalcalco",
-            "Cunduacán", "Emiliano Zapata", "Huimanguillo", "Jalapa",
-            "Jalpa de Méndez", "Jonuta", "Macuspana", "Nacajuca", "Paraíso",
-            "Tacotalpa", "Teapa", "Tenosique"
-        ]
-
-        modo = st.radio(
-            "Modo de comparación:",
-            ["Seleccionar dos cabeceras", "Comparar todas"],
-            horizontal=True,
-        )
-
-        # Calcular promedio por localidad
-        features = ee.FeatureCollection(os.getenv("GEE_LOCALITIES_ASSET"))
-        results = []
-
-        for muni in localidades:
-            roi = features.filter(ee.Filter.eq("NOMGEO", muni)).geometry()
-            lst_mean = (
-                lst_collection.mean()
-                .reduceRegion(
-                    reducer=ee.Reducer.mean(),
-                    geometry=roi,
-                    scale=30,
-                    maxPixels=1e9,
-                )
-                .getInfo()
-            )
-            if "ST_B10" in lst_mean and lst_mean["ST_B10"] is not None:
-                results.append({"Municipio": muni, "LST_promedio": float(lst_mean["ST_B10"])})
-
-        df_municipios = pd.DataFrame(results)
-
-        if modo == "Seleccionar dos cabeceras":
-            muni_1 = st.selectbox("Municipio 1", localidades, index=0)
-            muni_2 = st.selectbox("Municipio 2", localidades, index=1)
-            df_sel = df_municipios[df_municipios["Municipio"].isin([muni_1, muni_2])]
-            st.bar_chart(df_sel, x="Municipio", y="LST_promedio")
-        else:
-            st.bar_chart(df_municipios, x="Municipio", y="LST_promedio")
-
-        st.caption("Temperatura superficial promedio (°C) por cabecera municipal en el rango seleccionado.")
-
-def Información():
-    st.title("Acerca del Proyecto")
-
-    st.markdown("""
-    ### Descripción
-
-    Este proyecto tiene como objetivo permitir identificar, analizar y visualizar las 
-    **Islas de Calor Urbano (ICU)** en el municipio de **Teapa, Tabasco** como área de estudio principal, mediante el 
-    procesamiento de imágenes satelitales (Landsat 8) y el cálculo de la 
-    **Temperatura Superficial Terrestre (LST)**.  
-    El sistema integra **Google Earth Engine**, **Python** y **Streamlit** para automatizar el 
-    análisis geoespacial y mostrar los resultados de forma interactiva.
-
-    ---
-
-    ### Autores del desarrollo 
-    - **Adrian Lara Vázquez** — **Residente** — Estudiante de la carrera Ingeniería Informatíca del Instituto Tecnológico Superior de la Región Sierra.
-    - **Ing. Daniel Perez Flores** — **Colaborador y ayudante del proyecto** — Maestro e Ingeniero Informatíco del Instituto Tecnológico Superior de la Región Sierra.
-    - **M.I José de Jesús Lenin Valencia Cruz** — **Asesor Interno del proyecto** — Maestro e Ingeniero Informatíco del Instituto Tecnológico Superior de la Región Sierra.
-    - **Mtro. Candelario Peralta Carreta** — **Asesor Externo del proyecto** — Centro del Cambio Global y la Sustentabilidad en el Sureste A.C. (CCGSS).
-
-    ---
-
-    ### Instituciones participantes
-    - **Instituto Tecnológico Superior de la Región Sierra (ITSS)**  
-    - **Centro del Cambio Global y la Sustentabilidad en el Sureste A.C. (CCGSS)**
-    """)
-
-        
-# Router de las ventanas
-match st.session_state.window:
-    case "Mapas":
-        show_map_panel()
-    case "Gráficas":
-        show_graphics_panel()
-    case "Información":
-        Información()
-=======
-    if roi:
-        m = create_map()
-        centroid = roi.centroid().coordinates().getInfo()
-        m.location = [centroid[1], centroid[0]]
-        
-        empty = ee.Image().byte()
-        outline = empty.paint(featureCollection=ee.FeatureCollection([ee.Feature(roi)]), color=1, width=2)
-        m.add_ee_layer(outline, {'palette': '000000'}, "Límite Urbano")
+    start, end = st.session_state.date_strs
+    with st.spinner("Procesando imágenes..."):
+        result = compute_uhi(st.session_state.locality, start, end)
+
+    if result:
+        count = result["count"]
+
+        # El mapa se construye una vez por parámetros aplicados y se reutiliza en cada rerun:
+        # mismo objeto folium -> mismo HTML, y st_folium no vuelve a montar el iframe
+        map_key = (st.session_state.locality, start, end, st.session_state.basemap)
+        if st.session_state.get("cached_map_key") != map_key:
+            m = create_map(center=list(result["centroid"]) if result["centroid"] else None)
+            for name, url in result["layers"]:
+                folium.raster_layers.TileLayer(
+                    tiles=url, attr="Google Earth Engine", name=name, overlay=True, control=True,
+                ).add_to(m)
+            if count > 0:
+                add_legend(m, "Temperatura LST (°C)", VIZ_LST['palette'], VIZ_LST['min'], VIZ_LST['max'])
+            folium.LayerControl().add_to(m)
+            st.session_state.cached_map = m
+            st.session_state.cached_map_key = map_key
 
-        start = st.session_state.date_range[0].strftime("%Y-%m-%d")
-        end = st.session_state.date_range[1].strftime("%Y-%m-%d")
-        
-        col = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-               .filterBounds(roi).filterDate(start, end)
-               .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
-               .map(cloudMaskFunction).map(maskThermalNoData).map(addNDVI).map(addLST))
-        
-        count = col.size().getInfo()
         if count > 0:
-            mosaic = col.reduce(ee.Reducer.percentile([50])).clip(roi)
-            lst_band = mosaic.select("LST_p50")
-            ndvi_band = mosaic.select("NDVI_p50")
-            
-            # Escala calibrada
-            viz_lst = {"min": 25, "max": 55, "palette": ['blue', 'cyan', 'yellow', 'orange', 'red', 'maroon']}
-            m.add_ee_layer(lst_band, viz_lst, "1. LST (°C)")
-            add_legend(m, "Temperatura LST (°C)", viz_lst['palette'], viz_lst['min'], viz_lst['max'])
-            
-            p90 = lst_band.reduceRegion(ee.Reducer.percentile([90]), roi, 30).get("LST_p50")
-            p90_val_info = 0
-            if p90:
-                val_p90 = ee.Number(p90)
-                p90_val_info = p90.getInfo()
-                uhi = lst_band.gte(val_p90)
-                uhi_clean = uhi.updateMask(uhi.connectedPixelCount(100, True).gte(3)).selfMask()
-                m.add_ee_layer(uhi_clean, {"palette": ['#000000']}, f"2. Hotspots (> {p90_val_info:.1f}°C)")
-            
-            m.add_ee_layer(ndvi_band, {"min": 0, "max": 0.6, "palette": ['brown', 'white', 'green']}, "3. NDVI")
-            
-            p95_ndvi = ndvi_band.reduceRegion(ee.Reducer.percentile([95]), roi, 30).get("NDVI_p50")
-            p95_ndvi_info = 0
-            if p95_ndvi:
-                val_p95 = ee.Number(p95_ndvi)
-                p95_ndvi_info = p95_ndvi.getInfo()
-                veg_mask = ndvi_band.gte(val_p95).selfMask()
-                m.add_ee_layer(veg_mask, {"palette": ['#00FF00']}, f"4. Refugios Verdes (> {p95_ndvi_info:.2f})")
-
             st.success(f"Análisis basado en {count} imágenes procesadas.")
             c1, c2 = st.columns(2)
-            c1.metric("🔥 Umbral Calor Crítico (p90)", f"{p90_val_info:.2f} °C")
-            c2.metric("🌳 Umbral Alta Vegetación (p95)", f"{p95_ndvi_info:.2f} NDVI")
+            c1.metric("🔥 Umbral Calor Crítico (p90)", f"{result['p90'] or 0:.2f} °C")
+            c2.metric("🌳 Umbral Alta Vegetación (p95)", f"{result['p95'] or 0:.2f} NDVI")
         else:
             st.warning("Sin imágenes limpias en este periodo.")
         
-        folium.LayerControl().add_to(m)
-        
-        map_data = st_folium(m, width="100%", height=600)
+        # Clave estable por parámetros; solo se devuelve el último clic (lo usa el inspector de píxel)
+        map_data = st_folium(
+            st.session_state.cached_map, key=f"main_map_{st.session_state.locality}_{start}_{end}_{st.session_state.basemap}",
+            height=600, use_container_width=True, returned_objects=["last_clicked"],
+        )
         
         if map_data and map_data.get('last_clicked'):
             clicked_lat = map_data['last_clicked']['lat']
             clicked_lng = map_data['last_clicked']['lng']
             if count > 0:
+                _, _, mosaic = build_collection(st.session_state.locality, start, end)
                 point = ee.Geometry.Point([clicked_lng, clicked_lat])
-                values = mosaic.select(["LST_p50", "NDVI_p50"]).reduceRegion(
+                values = mosaic.select(["LST", "NDVI"]).reduceRegion(
                     reducer=ee.Reducer.first(), geometry=point, scale=30
                 ).getInfo()
                 
-                val_lst = values.get('LST_p50')
-                val_ndvi = values.get('NDVI_p50')
+                val_lst = values.get('LST')
+                val_ndvi = values.get('NDVI')
                 
                 st.info(f"📍 **Inspector:** Lat: {clicked_lat:.4f}, Lon: {clicked_lng:.4f}")
                 k1, k2 = st.columns(2)
@@ -646,156 +436,237 @@ match st.session_state.window:
         st.error("Localidad no encontrada.")
 
 
+@st.cache_data(ttl=1800, max_entries=64, show_spinner=False)
+def get_graphics_data(locality_name, start, end):
+    """Dispersión NDVI/LST, histograma, serie temporal y correlación del panel de gráficas"""
+    roi, col, mosaic = build_collection(locality_name, start, end)
+    if roi is None:
+        return None
+
+    # Sin imágenes el mosaico no tiene bandas: se devuelve una muestra vacía en el servidor
+    has_images = col.size().gt(0)
+    sample = ee.FeatureCollection(ee.Algorithms.If(
+        has_images,
+        # 60 m basta para la dispersión (Vega dibuja ~1000 puntos) y reduce 4x el trabajo por tesela
+        mosaic.select(["LST", "NDVI"]).sample(
+            region=roi, scale=60, numPixels=1000, seed=42, tileScale=4, geometries=False
+        ),
+        ee.FeatureCollection([]),
+    ))
+    # Histograma calculado en GEE sobre toda la ROI: solo viajan los conteos por intervalo.
+    # 100 m es la resolución nativa de la banda térmica (TIRS): a 30 m solo se cuentan píxeles remuestreados.
+    # clamp lleva los valores fuera de rango a los intervalos extremos (≤25 / ≥55) en vez de descartarlos
+    histogram = ee.Algorithms.If(
+        has_images,
+        mosaic.select("LST").clamp(HIST_MIN, HIST_MAX - 1e-6).reduceRegion(
+            reducer=ee.Reducer.fixedHistogram(HIST_MIN, HIST_MAX, HIST_BINS), geometry=roi,
+            scale=100, maxPixels=1e8, tileScale=4,
+        ).get("LST"),
+        None,
+    )
+
+    def get_mean_lst(img):
+        mean = img.select("LST").reduceRegion(ee.Reducer.mean(), roi, 100).get("LST")
+        return ee.Feature(None, {'date': img.date().format("YYYY-MM-dd"), 'LST_mean': mean})
+
+    # reduceColumns devuelve columnas paralelas: sin desempaquetar feature por feature
+    ts = (col.map(get_mean_lst).filter(ee.Filter.notNull(['LST_mean']))
+          .reduceColumns(ee.Reducer.toList().repeat(2), ['date', 'LST_mean']).get('list'))
+
+    info = ee.Dictionary({
+        "sample": sample.reduceColumns(ee.Reducer.toList().repeat(2), ['LST', 'NDVI']).get('list'),
+        "histogram": histogram,
+        "ts": ts,
+    }).getInfo()
+
+    sample_cols = info["sample"]
+    if not sample_cols[0]:
+        return None
+    df_scatter = pd.DataFrame({'LST': sample_cols[0], 'NDVI': sample_cols[1]})
+    corr = df_scatter['LST'].corr(df_scatter['NDVI'])
+
+    df_hist = None
+    if info["histogram"]:
+        df_hist = pd.DataFrame(info["histogram"], columns=['bin_left', 'count'])
+        df_hist['bin_right'] = df_hist['bin_left'] + (HIST_MAX - HIST_MIN) / HIST_BINS
+        df_hist['rango'] = [f"{a:.1f}–{b:.1f}" for a, b in zip(df_hist['bin_left'], df_hist['bin_right'])]
+        df_hist.loc[df_hist.index[0], 'rango'] = f"≤{df_hist['bin_right'].iloc[0]:.1f}"
+        df_hist.loc[df_hist.index[-1], 'rango'] = f"≥{df_hist['bin_left'].iloc[-1]:.1f}"
+
+    ts_cols = info["ts"]
+    df_ts = pd.DataFrame({'date': ts_cols[0], 'LST_mean': ts_cols[1]})
+    df_ts['date'] = pd.to_datetime(df_ts['date'], format="%Y-%m-%d")
+
+    return df_scatter, df_hist, df_ts, corr
+
+
+@st.fragment
 def show_graphics_panel():
     st.markdown(f"### 📊 Análisis Estadístico: {st.session_state.locality}")
     if not connect_with_gee(): return
-    roi = get_roi(st.session_state.locality)
-    if not roi: return
-
-    start = st.session_state.date_range[0].strftime("%Y-%m-%d")
-    end = st.session_state.date_range[1].strftime("%Y-%m-%d")
 
-    col = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-            .filterBounds(roi).filterDate(start, end)
-            .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
-            .map(cloudMaskFunction).map(maskThermalNoData).map(addLST).map(addNDVI))
+    start, end = st.session_state.date_strs
     
-    if col.size().getInfo() == 0:
+    with st.spinner("Calculando estadísticas..."):
+        data = get_graphics_data(st.session_state.locality, start, end)
+    if data is None:
         st.warning("No hay datos suficientes.")
         return
-
-    with st.spinner("Calculando estadísticas..."):
-        mosaic = col.reduce(ee.Reducer.percentile([50])).clip(roi)
-        sample = mosaic.select(["LST_p50", "NDVI_p50"]).sample(region=roi, scale=30, numPixels=1000, geometries=False)
-        data = sample.getInfo()['features']
-        
-        if data:
-            df = pd.DataFrame([x['properties'] for x in data])
-            
-            st.markdown("#### 1. Correlación Calor vs. Vegetación")
-            chart = alt.Chart(df).mark_circle(size=60, opacity=0.6).encode(
-                x=alt.X('NDVI_p50', title='Índice de Vegetación (NDVI)'),
-                y=alt.Y('LST_p50', title='Temperatura (°C)', scale=alt.Scale(zero=False)),
-                color=alt.Color('LST_p50', scale=alt.Scale(scheme='turbo')),
-                tooltip=['NDVI_p50', 'LST_p50']
-            ).properties(height=350).interactive()
-            st.altair_chart(chart, use_container_width=True)
-            
-            # --- RESULTADOS RESTAURADOS ---
-            # Calcular correlación
-            corr = df['LST_p50'].corr(df['NDVI_p50'])
-            st.info(f"📉 **Coeficiente de Correlación:** {corr:.2f}. (Un valor negativo indica que a mayor vegetación, menor temperatura).")
-            
-            st.markdown("#### 2. Distribución de Temperaturas")
-            hist = alt.Chart(df).mark_bar().encode(
-                x=alt.X('LST_p50', bin=alt.Bin(maxbins=20), title='Rango de Temperatura'),
-                y=alt.Y('count()', title='Frecuencia'),
-                color=alt.value('#ffaa00')
-            ).properties(height=300)
-            st.altair_chart(hist, use_container_width=True)
-        
-        st.markdown("---")
-        st.markdown("#### 3. Tendencia Histórica (Serie de Tiempo)")
+    df, df_hist, df_ts, corr = data
         
-        def get_mean_lst(img):
-            mean = img.reduceRegion(ee.Reducer.mean(), roi, 100).get("LST") 
-            return ee.Feature(None, {'date': img.date().format("YYYY-MM-dd"), 'LST_mean': mean})
-        
-        ts_features = col.map(get_mean_lst).filter(ee.Filter.notNull(['LST_mean'])).getInfo()['features']
-        
-        if ts_features:
-            df_ts = pd.DataFrame([x['properties'] for x in ts_features])
-            df_ts['date'] = pd.to_datetime(df_ts['date'])
-            
-            line_chart = alt.Chart(df_ts).mark_line(point=True).encode(
-                x=alt.X('date', title='Fecha de Captura', axis=alt.Axis(format='%Y-%m-%d')),
-                y=alt.Y('LST_mean', title='LST Promedio de la Ciudad (°C)', scale=alt.Scale(zero=False)),
-                tooltip=[alt.Tooltip('date', format='%Y-%m-%d'), alt.Tooltip('LST_mean', format='.1f')]
-            ).properties(height=350).interactive()
-            st.altair_chart(line_chart, use_container_width=True)
-        else:
-            st.info("No hay suficientes puntos temporales.")
+    st.markdown("#### 1. Correlación Calor vs. Vegetación")
+    chart = alt.Chart(df).mark_circle(size=60, opacity=0.6).encode(
+        x=alt.X('NDVI', title='Índice de Vegetación (NDVI)'),
+        y=alt.Y('LST', title='Temperatura (°C)', scale=alt.Scale(zero=False)),
+        color=alt.Color('LST', scale=alt.Scale(scheme='turbo')),
+        tooltip=['NDVI', 'LST']
+    ).properties(height=350).interactive()
+    st.altair_chart(chart, use_container_width=True)
+    
+    # --- RESULTADOS RESTAURADOS ---
+    st.info(f"📉 **Coeficiente de Correlación:** {corr:.2f}. (Un valor negativo indica que a mayor vegetación, menor temperatura).")
+    
+    st.markdown("#### 2. Distribución de Temperaturas")
+    if df_hist is not None:
+        hist = alt.Chart(df_hist).mark_bar().encode(
+            # Los intervalos extremos incluyen todo lo que queda fuera de la escala
+            x=alt.X('bin_left:Q', title='Rango de Temperatura', axis=alt.Axis(
+                labelExpr=f"datum.value <= {HIST_MIN} ? '≤{HIST_MIN}' : datum.value >= {HIST_MAX} ? '≥{HIST_MAX}' : datum.label"
+            )),
+            x2='bin_right:Q',
+            y=alt.Y('count:Q', title='Frecuencia'),
+            color=alt.value('#ffaa00'),
+            tooltip=[alt.Tooltip('rango:N', title='Rango (°C)'), alt.Tooltip('count:Q', title='Frecuencia')]
+        ).properties(height=300)
+        st.altair_chart(hist, use_container_width=True)
+    
+    st.markdown("---")
+    st.markdown("#### 3. Tendencia Histórica (Serie de Tiempo)")
+    
+    if not df_ts.empty:
+        line_chart = alt.Chart(df_ts).mark_line(point=True).encode(
+            x=alt.X('date', title='Fecha de Captura', axis=alt.Axis(format='%Y-%m-%d')),
+            y=alt.Y('LST_mean', title='LST Promedio de la Ciudad (°C)', scale=alt.Scale(zero=False)),
+            tooltip=[alt.Tooltip('date', format='%Y-%m-%d'), alt.Tooltip('LST_mean', format='.1f')]
+        ).properties(height=350).interactive()
+        st.altair_chart(line_chart, use_container_width=True)
+    else:
+        st.info("No hay suficientes puntos temporales.")
+
+
+def comparison_collection(names, start, end):
+    """ROI (referencias al asset) y colección LST de la comparativa (objetos GEE diferidos)"""
+    # Nombres ya validados por get_rois_info: sin consultas previas por ciudad
+    roi_fc = ee.FeatureCollection([ee.Feature(_locality_geometry(city), {'city': city}) for city in names])
+    col = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
+           .filterBounds(roi_fc).filterDate(start, end)
+           .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
+           .map(preprocess_lst_only))
+    return roi_fc, col
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def compute_comparison(names, start, end):
+    """Media/máxima y serie temporal de LST para varias ROI en una sola consulta GEE (reduceRegions)"""
+    roi_fc, col = comparison_collection(names, start, end)
+    lst = col.select("LST").median()
+
+    # Todas las ciudades en un solo reduceRegions; nulo en el servidor si no hay imágenes
+    city_reductions = lst.reduceRegions(
+        collection=roi_fc,
+        reducer=ee.Reducer.mean().combine(reducer2=ee.Reducer.max(), sharedInputs=True),
+        scale=100, tileScale=4,
+    )
+    stats = ee.Algorithms.If(
+        col.size().gt(0),
+        city_reductions.filter(ee.Filter.notNull(['mean']))
+        .reduceColumns(ee.Reducer.toList().repeat(3), ['city', 'mean', 'max']).get('list'),
+        None,
+    )
+
+    def per_image(img):
+        date = img.date().format("YYYY-MM-dd")
+        return (img.select("LST").reduceRegions(collection=roi_fc, reducer=ee.Reducer.mean(), scale=200)
+                .map(lambda f: f.set('date', date)))
+
+    ts = (col.map(per_image).flatten().filter(ee.Filter.notNull(['mean']))
+          .reduceColumns(ee.Reducer.toList().repeat(3), ['date', 'mean', 'city']).get('list'))
+
+    info = ee.Dictionary({"stats": stats, "ts": ts}).getInfo()
+    city_stats = {}
+    if info["stats"]:
+        for city, mean, max_val in zip(*info["stats"]):
+            city_stats[city] = {"LST_mean": mean, "LST_max": max_val}
+    ts_cols = info["ts"]
+    df_ts = pd.DataFrame({'date': ts_cols[0], 'val': ts_cols[1], 'city': ts_cols[2]})
+    return city_stats, df_ts
 
 
+@st.fragment
 def show_comparison_panel():
     st.markdown("### ⚖️ Comparativa de Ciudades")
     if not connect_with_gee(): return
 
-    ciudades_disp = [
-        "Villahermosa", "Teapa", "Cárdenas", "Comalcalco", "Paraíso", 
-        "Frontera", "Macuspana", "Tenosique", "Huimanguillo", "Cunduacán", 
-        "Jalpa de Méndez", "Nacajuca", "Jalapa", "Tacotalpa", "Emiliano Zapata"
-    ]
-    
     selected = st.multiselect(
-        "Selecciona 2 ciudades:", 
-        ciudades_disp, 
-        default=st.session_state.compare_cities[:2],
-        max_selections=2
+        "Selecciona 2 o más ciudades:", 
+        CIUDADES, 
+        default=st.session_state.compare_cities,
     )
 
-    if len(selected) != 2:
-        st.info("Selecciona exactamente 2 ciudades.")
+    if len(selected) < 2:
+        st.info("Selecciona al menos 2 ciudades.")
         return
 
-    start = st.session_state.date_range[0].strftime("%Y-%m-%d")
-    end = st.session_state.date_range[1].strftime("%Y-%m-%d")
+    start, end = st.session_state.date_strs
     
     stats_data = []
-    timeseries_data = []
 
-    c1, c2 = st.columns(2)
-    cols = [c1, c2]
+    rois = get_rois_info(tuple(selected))
+
+    geojsons = {city: rois[city][0] for city in selected if city in rois}
+
+    # Estadísticas y serie temporal de todas las ciudades en una sola consulta (en caché por ciudades y periodo);
+    # el compuesto para los mapas se reconstruye diferido, sin consultar GEE
+    if geojsons:
+        names = tuple(geojsons)
+        city_stats, df_ts = compute_comparison(names, start, end)
+        lst = comparison_collection(names, start, end)[1].select("LST").median()
+    else:
+        city_stats, df_ts, lst = {}, pd.DataFrame(columns=['date', 'val', 'city']), None
+
+    # Hasta 3 mapas por fila; con más ciudades se abre una fila nueva
+    n_cols = min(len(selected), 3)
 
     for idx, city in enumerate(selected):
-        with cols[idx]:
+        if idx % n_cols == 0:
+            cols = st.columns(n_cols)
+        with cols[idx % n_cols]:
             st.subheader(f"📍 {city}")
-            roi = get_roi(city)
             
-            if roi:
-                col = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-                       .filterBounds(roi).filterDate(start, end)
-                       .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
-                       .map(cloudMaskFunction).map(maskThermalNoData).map(addLST))
+            if city not in geojsons:
+                st.error("Error cargando geometría.")
+            elif city in city_stats:
+                stats = city_stats[city]
+                stats_data.append({
+                    "Ciudad": city,
+                    "LST Promedio (°C)": stats.get("LST_mean"),
+                    "LST Máxima (°C)": stats.get("LST_max")
+                })
                 
-                if col.size().getInfo() > 0:
-                    mosaic = col.reduce(ee.Reducer.percentile([50])).clip(roi)
-                    lst = mosaic.select("LST_p50")
-                    
-                    stats = lst.reduceRegion(
-                        reducer=ee.Reducer.mean().combine(reducer2=ee.Reducer.max(), sharedInputs=True),
-                        geometry=roi, scale=100, bestEffort=True
-                    ).getInfo()
-                    
-                    stats_data.append({
-                        "Ciudad": city,
-                        "LST Promedio (°C)": stats.get("LST_p50_mean"),
-                        "LST Máxima (°C)": stats.get("LST_p50_max")
-                    })
-                    
-                    centroid = roi.centroid().coordinates().getInfo()
-                    m = create_map(center=[centroid[1], centroid[0]], height=350)
-                    viz = {"min": 25, "max": 55, "palette": ['blue', 'cyan', 'yellow', 'orange', 'red', 'maroon']}
-                    m.add_ee_layer(lst, viz, "Temperatura")
-                    add_legend(m, f"LST {city}", viz['palette'], viz['min'], viz['max'])
-                    
-                    empty = ee.Image().byte()
-                    outline = empty.paint(featureCollection=ee.FeatureCollection([ee.Feature(roi)]), color=1, width=2)
-                    m.add_ee_layer(outline, {'palette': 'black'}, "Límite")
-                    
-                    st_folium(m, width="100%", height=350, key=f"map_{city}")
-                    
-                    def get_ts(img):
-                        mean_val = img.reduceRegion(ee.Reducer.mean(), roi, 200).get("LST")
-                        return ee.Feature(None, {'date': img.date().format("YYYY-MM-dd"), 'val': mean_val, 'city': city})
-                    
-                    ts_feats = col.map(get_ts).filter(ee.Filter.notNull(['val'])).getInfo()['features']
-                    for f in ts_feats:
-                        timeseries_data.append(f['properties'])
-                else:
-                    st.warning("Sin datos.")
+                geojson, centroid = rois[city]
+                m = create_map(center=list(centroid) if centroid else None, height=350)
+                m.fit_bounds(polygon_bounds(geojson))
+                roi = _locality_geometry(city)
+                m.add_ee_layer(lst.clip(roi), VIZ_LST, "Temperatura")
+                add_legend(m, f"LST {city}", VIZ_LST['palette'], VIZ_LST['min'], VIZ_LST['max'])
+                
+                m.add_ee_layer(roi, {'palette': 'black'}, "Límite")
+                
+                st_folium(
+                    m, height=350, key=f"map_{city}_{start}_{end}",
+                    returned_objects=[], use_container_width=True,
+                )
             else:
-                st.error("Error cargando geometría.")
+                st.warning("Sin datos.")
 
     st.markdown("---")
     st.subheader("📊 Resultados Comparativos")
@@ -803,7 +674,7 @@ def show_comparison_panel():
 
     if stats_data:
         df_stats = pd.DataFrame(stats_data)
-        df_ts = pd.DataFrame(timeseries_data)
+        df_ts = df_ts[df_ts['city'].isin(df_stats['Ciudad'])].copy()
         
         st.markdown("##### 1. Promedios y Máximos")
         df_melt = df_stats.melt("Ciudad", var_name="Métrica", value_name="Temperatura")
@@ -812,14 +683,14 @@ def show_comparison_panel():
             y=alt.Y('Temperatura', title='Grados Celsius'),
             color='Métrica',
             column=alt.Column('Ciudad', header=alt.Header(titleOrient="bottom"))
-        ).properties(width=300, height=300).configure_view(stroke='transparent')
+        ).properties(width=min(300, 900 // len(df_stats)), height=300).configure_view(stroke='transparent')
         st.altair_chart(bar_chart)
         
         st.markdown("---")
         
         if not df_ts.empty:
             st.markdown("##### 2. Evolución Temporal Simultánea")
-            df_ts['date'] = pd.to_datetime(df_ts['date'])
+            df_ts['date'] = pd.to_datetime(df_ts['date'], format="%Y-%m-%d")
             line_chart = alt.Chart(df_ts).mark_line(point=True).encode(
                 x=alt.X('date', title='Fecha de Captura'),
                 y=alt.Y('val', title='LST Promedio de la Ciudad (°C)', scale=alt.Scale(zero=False)),
@@ -829,62 +700,71 @@ def show_comparison_panel():
             st.altair_chart(line_chart, use_container_width=True)
 
 
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def get_report_data(locality_name, start, end):
+    """Serie temporal (media/máxima) y muestra de píxeles para exportar a CSV"""
+    roi, col, mosaic = build_collection(locality_name, start, end)
+    if roi is None:
+        return None
+
+    def get_ts_export(img):
+        # Solo la banda LST y media+máximo en una sola pasada sobre los píxeles
+        stats = img.select("LST").reduceRegion(
+            ee.Reducer.mean().combine(reducer2=ee.Reducer.max(), sharedInputs=True), roi, 100
+        )
+        return ee.Feature(None, {
+            'Fecha': img.date().format("YYYY-MM-dd"), 
+            'LST_Promedio': stats.get("LST_mean"),
+            'LST_Maxima': stats.get("LST_max")
+        })
+    
+    ts_columns = ['Fecha', 'LST_Promedio', 'LST_Maxima']
+    ts_export = (col.map(get_ts_export).filter(ee.Filter.notNull(['LST_Promedio']))
+                 .reduceColumns(ee.Reducer.toList().repeat(3), ts_columns).getInfo()['list'])
+    df_ts = pd.DataFrame(dict(zip(ts_columns, ts_export)))
+    # Sin serie no hay imágenes válidas: el mosaico no tiene bandas y no se puede muestrear
+    if df_ts.empty:
+        return df_ts, None
+
+    # Coordenadas como bandas en lugar de geometrías: la muestra llega en columnas
+    sample = (mosaic.select(["LST", "NDVI"]).addBands(ee.Image.pixelLonLat())
+              .sample(region=roi, scale=100, numPixels=500, geometries=False))
+    sample_cols = sample.reduceColumns(
+        ee.Reducer.toList().repeat(4), ['longitude', 'latitude', 'LST', 'NDVI']
+    ).getInfo()['list']
+    df_sample = None
+    if sample_cols[0]:
+        df_sample = pd.DataFrame(dict(zip(["Lon", "Lat", "LST_C", "NDVI"], sample_cols)))
+    return df_ts, df_sample
+
+
+@st.fragment
 def show_report_panel():
     st.markdown(f"### 📥 Descarga de Datos: {st.session_state.locality}")
     if not connect_with_gee(): return
-    roi = get_roi(st.session_state.locality)
-    if not roi: return
-
-    start = st.session_state.date_range[0].strftime("%Y-%m-%d")
-    end = st.session_state.date_range[1].strftime("%Y-%m-%d")
 
-    col = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-            .filterBounds(roi).filterDate(start, end)
-            .filter(ee.Filter.lt("CLOUD_COVER", MAX_NUBES))
-            .map(cloudMaskFunction).map(maskThermalNoData).map(addLST).map(addNDVI))
+    start, end = st.session_state.date_strs
+    data = get_report_data(st.session_state.locality, start, end)
+    if data is None: return
+    df_ts, df_sample = data
 
-    if col.size().getInfo() == 0:
+    # La serie vacía indica que no hay imágenes válidas: sirve de verificación sin consultar col.size()
+    if df_ts.empty:
         st.warning("No hay datos para exportar.")
         return
     
     st.info("Generando archivos para exportación...")
 
-    mosaic = col.reduce(ee.Reducer.percentile([50])).clip(roi)
-    
-    def get_ts_export(img):
-        mean = img.reduceRegion(ee.Reducer.mean(), roi, 100).get("LST")
-        max_val = img.reduceRegion(ee.Reducer.max(), roi, 100).get("LST")
-        return ee.Feature(None, {
-            'Fecha': img.date().format("YYYY-MM-dd"), 
-            'LST_Promedio': mean,
-            'LST_Maxima': max_val
-        })
-    
-    ts_export = col.map(get_ts_export).filter(ee.Filter.notNull(['LST_Promedio'])).getInfo()['features']
-    df_ts = pd.DataFrame([x['properties'] for x in ts_export])
-
     st.markdown("#### Datos Disponibles")
     c1, c2 = st.columns(2)
     
-    if not df_ts.empty:
-        csv_ts = df_ts.to_csv(index=False).encode('utf-8')
-        c1.download_button(
-            "📅 Descargar Serie Temporal (.csv)",
-            csv_ts, f"serie_tiempo_{st.session_state.locality}.csv", "text/csv"
-        )
+    csv_ts = df_ts.to_csv(index=False).encode('utf-8')
+    c1.download_button(
+        "📅 Descargar Serie Temporal (.csv)",
+        csv_ts, f"serie_tiempo_{st.session_state.locality}.csv", "text/csv"
+    )
     
-    sample = mosaic.select(["LST_p50", "NDVI_p50"]).sample(region=roi, scale=100, numPixels=500, geometries=True)
-    data_sample = sample.getInfo()['features']
-    if data_sample:
-        rows = []
-        for feat in data_sample:
-            props = feat['properties']
-            coords = feat['geometry']['coordinates']
-            rows.append({
-                "Lon": coords[0], "Lat": coords[1], 
-                "LST_C": props.get("LST_p50"), "NDVI": props.get("NDVI_p50")
-            })
-        df_sample = pd.DataFrame(rows)
+    if df_sample is not None:
         csv_sample = df_sample.to_csv(index=False).encode('utf-8')
         c2.download_button(
             "📍 Descargar Puntos Muestreo (.csv)",
@@ -920,42 +800,59 @@ with st.sidebar:
     st.markdown("---")
     st.session_state.window = st.radio("Menú", ["Mapas", "Gráficas", "Comparativa", "Descargas", "Info"])
     
-    if st.session_state.window != "Comparativa":
-        ciudades = [
-            "Villahermosa", "Teapa", "Cárdenas", "Comalcalco", "Paraíso", 
-            "Frontera", "Macuspana", "Tenosique", "Huimanguillo", "Cunduacán", 
-            "Jalpa de Méndez", "Nacajuca", "Jalapa", "Tacotalpa", "Emiliano Zapata"
-        ]
-        st.session_state.locality = st.selectbox("Ciudad Principal", ciudades)
-    
-    st.markdown("### Periodo de Análisis")
-    
-    col_dates1, col_dates2 = st.columns(2)
-    
-    start_val = st.session_state.date_range[0]
-    end_val = st.session_state.date_range[1]
-    
-    with col_dates1:
-        new_start = st.date_input(
-            "Fecha Inicial",
-            value=start_val,
-            max_value=dt.date.today(),
-            format="DD/MM/YYYY"
-        )
-    
-    with col_dates2:
-        new_end = st.date_input(
-            "Fecha Final",
-            value=end_val,
-            min_value=new_start,
-            max_value=dt.date.today(),
-            format="DD/MM/YYYY"
+    # Los controles se aplican solo al enviar el formulario: cambiar un widget no relanza GEE
+    with st.form("controls"):
+        if st.session_state.window != "Comparativa":
+            new_locality = st.selectbox(
+                "Ciudad Principal", CIUDADES, index=CIUDADES.index(st.session_state.locality)
+            )
+        else:
+            new_locality = st.session_state.locality
+        
+        st.markdown("### Periodo de Análisis")
+        
+        col_dates1, col_dates2 = st.columns(2)
+        
+        start_val = st.session_state.date_range[0]
+        end_val = st.session_state.date_range[1]
+        
+        with col_dates1:
+            new_start = st.date_input(
+                "Fecha Inicial",
+                value=start_val,
+                max_value=dt.date.today(),
+                format="DD/MM/YYYY"
+            )
+        
+        with col_dates2:
+            new_end = st.date_input(
+                "Fecha Final",
+                value=end_val,
+                max_value=dt.date.today(),
+                format="DD/MM/YYYY"
+            )
+        
+        new_basemap = st.selectbox(
+            "Mapa base", list(BASEMAPS), index=list(BASEMAPS).index(st.session_state.basemap)
         )
+        
+        submitted = st.form_submit_button("Aplicar")
     
-    st.session_state.date_range = (new_start, new_end)
+    if submitted:
+        if new_end < new_start:
+            st.error("La fecha final debe ser posterior a la inicial.")
+        else:
+            st.session_state.locality = new_locality
+            st.session_state.basemap = new_basemap
+            st.session_state.coordinates = COORDENADAS.get(
+                st.session_state.locality, st.session_state.coordinates
+            )
+            st.session_state.date_range = (new_start, new_end)
+            st.session_state.date_strs = (new_start.strftime("%Y-%m-%d"), new_end.strftime("%Y-%m-%d"))
     
     st.markdown("---")
     if st.button("🔄 Recargar"):
+        _init_gee.clear()
         st.session_state.gee_available = False
         st.rerun()
 
@@ -970,4 +867,3 @@ elif st.session_state.window == "Descargas":
     show_report_panel()
 else:
     show_info_panel()
->>>>>>> 0cd58a8ab27ed53b33f2f11119cb2eec3cec2352